@@ -1,45 +1,163 @@
 import json
 import time
+import sys
+import atexit
+import signal
 import sqlite3
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
 from sqlite3 import Error
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from loguru import logger
 
 class AquisitionDBStore():
-    def __init__(self, db_path: str = None):
+    CREATE_INVERTER_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS inverter_data (
+                              id INTEGER PRIMARY KEY,
+                              timestamp REAL,
+                              inverter_number INTEGER,
+                              num_cells INTEGER,
+                              inverter_power REAL,
+                              yield_day REAL,
+                              yield_total REAL)'''
+    CREATE_SUM_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS inverter_sum_data (
+                            id INTEGER PRIMARY KEY,
+                            timestamp REAL,
+                            power_sum REAL,
+                            yield_day_sum REAL,
+                            yield_total_sum REAL)'''
+    CREATE_ENERGY_METER_TABLE_SQL = '''CREATE TABLE IF NOT EXISTS energy_meter_data (
+                              id INTEGER PRIMARY KEY,
+                              timestamp REAL,
+                              total_out REAL,
+                              total_in REAL,
+                              power_in REAL,
+                              meter_number TEXT)'''
+    CREATE_INVERTER_INDEX_SQL = "CREATE INDEX IF NOT EXISTS ix_inv_ts ON inverter_data(timestamp)"
+    CREATE_SUM_INDEX_SQL = "CREATE INDEX IF NOT EXISTS ix_inv_sum_ts ON inverter_sum_data(timestamp)"
+    CREATE_ENERGY_METER_INDEX_SQL = "CREATE INDEX IF NOT EXISTS ix_energy_meter_ts ON energy_meter_data(timestamp)"
+    INSERT_INVERTER_SQL = '''INSERT INTO inverter_data
+                 (timestamp, inverter_number, num_cells, inverter_power, yield_day, yield_total)
+                 VALUES (?, ?, ?, ?, ?, ?)'''
+    INSERT_SUM_SQL = '''INSERT INTO inverter_sum_data (timestamp, power_sum, yield_day_sum, yield_total_sum)
+                VALUES (?, ?, ?, ?)'''
+    INSERT_ENERGY_METER_SQL = '''INSERT INTO energy_meter_data
+                 (timestamp, total_out, total_in, power_in, meter_number)
+                 VALUES (?, ?, ?, ?, ?)'''
+    # Number of cycles buffered in memory before they are committed
+    FLUSH_EVERY = 5
+
+    def __init__(self, db_path: str, dtu_url: str, tasmota_url: str):
         self.db_path = db_path
+        self._dtu_live_url = f"{dtu_url}/api/record/live"
+        self._tasmota_url = f"{tasmota_url}/cm?cmnd=Status%2010"
         self.dtu_data = None
         self.tasmota_data = None
-
-    def get_dtu_data(self, dtu_url: str):
+        self._indexed = None
+        self._meter = None
+
+        # Rows waiting for the next commit
+        self._pending_inverter = []
+        self._pending_sum = []
+        self._pending_meter = []
+
+        # Reuse keep-alive connections to the DTU and the energy meter
+        self._http = requests.Session()
+        self._http.mount("http://", HTTPAdapter(pool_connections=2, pool_maxsize=4))
+        self._executor = ThreadPoolExecutor(max_workers=2)
+
+        # Keep one connection open for the lifetime of the process
+        self.conn = self.create_connection(db_path)
+        if self.conn is None:
+            raise RuntimeError(f"Cannot create the database connection to {db_path}")
+        self.migrate_inverter_table(self.conn)
+        self.create_table(self.conn)
+        self.create_sum_table(self.conn)
+        self.create_energy_meter_table(self.conn)
+        atexit.register(self.flush)
+
+    def get_dtu_data(self):
+        """
+        Get the live data from the DTU
+        """
         try:
-            url = f"{dtu_url}/api/record/live"
-            response = requests.get(url)
+            response = self._http.get(self._dtu_live_url, timeout=5)
             response.raise_for_status()
-            response = response.json()
+            response = orjson.loads(response.content)
             self.dtu_data = response
-        except requests.exceptions.HTTPError as e:
-            print(e)
+            self._reindex()
+            return response
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
+            print(f"Error fetching DTU data: {e}")
             logger.error(e)
-        return response
+            return None
     
-    def get_tasmota_data(self, tasmota_url: str):
+    def get_tasmota_data(self):
         """
         Get the data from the Tasmota energy meter
         """
-        url = f"{tasmota_url}/cm?cmnd=Status%2010"
         try:
-            response = requests.get(url)
+            response = self._http.get(self._tasmota_url, timeout=5)
             response.raise_for_status()
-            data = response.json()
+            data = orjson.loads(response.content)
             data = data['StatusSNS']
             self.tasmota_data = data
+            self._meter = self._extract_meter(data)
             return data
-        except requests.RequestException as e:
+        except (requests.RequestException, orjson.JSONDecodeError) as e:
             print(f"Error fetching Tasmota data: {e}")
+            # Do not store the last meter reading again
+            self._meter = None
             return None
     
+    def get_data(self):
+        """
+        Fetch the DTU and the Tasmota data concurrently
+        ----------------
+        Returns:
+            data: tuple
+                The DTU data and the Tasmota data, None for a failed fetch
+        """
+        dtu_future = self._executor.submit(self.get_dtu_data)
+        tasmota_future = self._executor.submit(self.get_tasmota_data)
+        return dtu_future.result(), tasmota_future.result()
+
+    @staticmethod
+    def _extract_meter(data: dict):
+        """
+        Get the energy meter values from the Tasmota StatusSNS data
+        ----------------
+        Parameters:
+            data: dict
+                The StatusSNS data
+        Returns:
+            meter: dict
+                The energy meter values, None if no meter is found
+        """
+        # The meter values are nested under the (user defined) meter name
+        for sensor in data.values():
+            if isinstance(sensor, dict) and ("Total_in" in sensor or "Total_out" in sensor):
+                return {
+                    "total_out": sensor.get("Total_out", 0),
+                    "total_in": sensor.get("Total_in", 0),
+                    "power_in": sensor.get("Power_in", 0),
+                    "meter_number": sensor.get("Meter_Number", ""),
+                }
+        return None
+
+    def _reindex(self):
+        """ Bucket the values of every inverter by field name in a single pass """
+        self._indexed = []
+        for inv in self.dtu_data["inverter"]:
+            d = {}
+            for item in inv:
+                d.setdefault(item["fld"], []).append(item["val"])
+            self._indexed.append(d)
+
+    def _cell_values(self, inverter: int, fld: str):
+        """ Get the per-cell values of a field, the last value is the inverter total """
+        return self._indexed[inverter].get(fld, [])[:-1]
+
     @property
     def num_inverter(self):
         return len(self.dtu_data["inverter"])
@@ -58,8 +176,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        p_dc_count = sum(1 for item in self.dtu_data["inverter"][inverter] if item["fld"] == "P_DC")
-        return p_dc_count - 1
+        return len(self._indexed[inverter]["P_DC"]) - 1
         
 
     def cell_power(self, inverter: int):
@@ -76,13 +193,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        cell_power = []
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "P_DC":
-                cell_power.append(item["val"])
-        # Remove last element as it is the total power
-        cell_power.pop()
-        return cell_power
+        return self._cell_values(inverter, "P_DC")
 
     def cell_voltage(self, inverter: int):
         """
@@ -98,13 +209,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        cell_voltage = []
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "U_DC":
-                cell_voltage.append(item["val"])
-        # Remove last element as it is the total voltage
-        cell_voltage.pop()
-        return cell_voltage
+        return self._cell_values(inverter, "U_DC")
     
     def cell_current(self, inverter: int):
         """
@@ -120,13 +225,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        cell_current = []
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "I_DC":
-                cell_current.append(item["val"])
-        # Remove last element as it is the total current
-        cell_current.pop()
-        return cell_current
+        return self._cell_values(inverter, "I_DC")
 
     def cell_yield_day(self, inverter: int):
         """
@@ -142,13 +241,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        cell_yield_day = []
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "YieldDay":
-                cell_yield_day.append(item["val"])
-        # Remove last element as it is the total yield
-        cell_yield_day.pop()
-        return cell_yield_day
+        return self._cell_values(inverter, "YieldDay")
 
     def cell_yield_total(self, inverter: int):
         """
@@ -164,13 +257,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        cell_yield_total = []
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "YieldTotal":
-                cell_yield_total.append(item["val"])
-        # Remove last element as it is the total yield
-        cell_yield_total.pop()
-        return cell_yield_total
+        return self._cell_values(inverter, "YieldTotal")
     
     def cell_irradiation(self, inverter: int):
         """
@@ -186,11 +273,7 @@ class AquisitionDBStore():
         if inverter >= self.num_inverter:
             raise IndexError("Inverter index out of range")
 
-        cell_irradiation = []
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "Irradiation":
-                cell_irradiation.append(item["val"])
-        return cell_irradiation
+        return list(self._indexed[inverter].get("Irradiation", []))
     
     def inverter_power(self, inverter: int):
         """
@@ -201,11 +284,7 @@ class AquisitionDBStore():
                 The inverter power
         """
         # Inverter power is "P_AC"
-        inverter_power: int
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "P_AC":
-                inverter_power = item["val"]
-        return inverter_power
+        return self._indexed[inverter]["P_AC"][-1]
     
     def inverter_yield_day(self, inverter: int):
         """
@@ -216,11 +295,7 @@ class AquisitionDBStore():
                 The inverter yield day
         """
         # Inverter yield day is "YieldDay"
-        inverter_yield_day: int
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "YieldDay":
-                inverter_yield_day = item["val"]
-        return float(inverter_yield_day) / 1000 # Convert to kWh
+        return float(self._indexed[inverter]["YieldDay"][-1]) / 1000 # Convert to kWh
     
     def inverter_yield_total(self, inverter: int):
         """
@@ -231,162 +306,152 @@ class AquisitionDBStore():
                 The inverter yield total
         """
         # Inverter yield total is "YieldTotal"
-        inverter_yield_total: int
-        for item in self.dtu_data["inverter"][inverter]:
-            if item["fld"] == "YieldTotal":
-                inverter_yield_total = item["val"]
-        return float(inverter_yield_total) / 1000 # Convert to kWh
+        return float(self._indexed[inverter]["YieldTotal"][-1]) / 1000 # Convert to kWh
 
     def create_connection(self, db_file):
         """ Create a database connection to the SQLite database """
         conn = None
         try:
-            conn = sqlite3.connect(db_file)
+            conn = sqlite3.connect(db_file, isolation_level=None, check_same_thread=False)
+            # Only takes effect on a fresh database, before WAL is enabled
+            conn.execute("PRAGMA page_size=8192")
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA journal_size_limit=6144000")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute("PRAGMA cache_size=-65536")  # 64 MB
+            conn.execute("PRAGMA mmap_size=268435456")  # 256 MB
             return conn
         except Error as e:
             logger.error(e)
         return conn
 
     def create_table(self, conn):
-        """ Create a table if it does not exist """
+        """ Create a table and its timestamp index if they do not exist """
         try:
             cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS inverter_data (
-                              id INTEGER PRIMARY KEY,
-                              timestamp REAL,
-                              inverter_number REAL,
-                              num_cells TEXT,
-                              inverter_power TEXT,
-                              yield_day TEXT,
-                              yield_total TEXT)''')
+            cursor.execute(self.CREATE_INVERTER_TABLE_SQL)
+            cursor.execute(self.CREATE_INVERTER_INDEX_SQL)
         except Error as e:
             print(e)
             logger.error(e)
 
+    def migrate_inverter_table(self, conn):
+        """ Rewrite an inverter table created with TEXT columns to numeric columns """
+        columns = {row[1]: row[2] for row in conn.execute("PRAGMA table_info(inverter_data)")}
+        if columns.get("inverter_power") != "TEXT":
+            return
+        logger.info("Migrating inverter_data to numeric column types")
+        with conn:
+            conn.execute("BEGIN")
+            conn.execute("ALTER TABLE inverter_data RENAME TO inverter_data_old")
+            conn.execute("DROP INDEX IF EXISTS ix_inv_ts")
+            conn.execute(self.CREATE_INVERTER_TABLE_SQL)
+            conn.execute('''INSERT INTO inverter_data
+                            (id, timestamp, inverter_number, num_cells, inverter_power, yield_day, yield_total)
+                            SELECT id, timestamp, CAST(inverter_number AS INTEGER), CAST(num_cells AS INTEGER),
+                                   CAST(inverter_power AS REAL), CAST(yield_day AS REAL), CAST(yield_total AS REAL)
+                            FROM inverter_data_old''')
+            conn.execute("DROP TABLE inverter_data_old")
+
     def create_sum_table(self, conn):
-        """ Create a sum table if it does not exist """
+        """ Create a sum table and its timestamp index if they do not exist """
         try:
             cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS inverter_sum_data (
-                            id INTEGER PRIMARY KEY,
-                            timestamp REAL,
-                            power_sum REAL,
-                            yield_day_sum REAL,
-                            yield_total_sum REAL)''')
+            cursor.execute(self.CREATE_SUM_TABLE_SQL)
+            cursor.execute(self.CREATE_SUM_INDEX_SQL)
         except Error as e:
             print(e)
             logger.error(e)
 
 
-    def insert_inverter_data(self, conn, data):
-        """ Insert data into the table """
-        sql = '''INSERT INTO inverter_data
-                 (timestamp, inverter_number, num_cells, inverter_power, yield_day, yield_total)
-                 VALUES (?, ?, ?, ?, ?, ?)'''
+    def insert_inverter_data(self, conn, rows):
+        """ Insert rows into the table """
         try:
             cursor = conn.cursor()
-            cursor.execute(sql, data)
+            cursor.executemany(self.INSERT_INVERTER_SQL, rows)
         except Error as e:
             print(e)
             logger.error(e)
 
-    def insert_sum_data(self, conn, data):
-        """ Insert sum data into the table """
-        sql = '''INSERT INTO inverter_sum_data (timestamp, power_sum, yield_day_sum, yield_total_sum)
-                VALUES (?, ?, ?, ?)'''
+    def insert_sum_data(self, conn, rows):
+        """ Insert sum rows into the table """
         try:
             cursor = conn.cursor()
-            cursor.execute(sql, data)
+            cursor.executemany(self.INSERT_SUM_SQL, rows)
         except Error as e:
             print(e)
             logger.error(e)
 
     def create_energy_meter_table(self, conn):
-        """ Create a table for the energy meter data if it does not exist """
+        """ Create a table and timestamp index for the energy meter data if they do not exist """
         try:
             cursor = conn.cursor()
-            cursor.execute('''CREATE TABLE IF NOT EXISTS energy_meter_data (
-                              id INTEGER PRIMARY KEY,
-                              timestamp REAL,
-                              total_out REAL,
-                              total_in REAL,
-                              power_in REAL,
-                              meter_number TEXT)''')
+            cursor.execute(self.CREATE_ENERGY_METER_TABLE_SQL)
+            cursor.execute(self.CREATE_ENERGY_METER_INDEX_SQL)
         except Error as e:
             print(e)
 
-    def insert_energy_meter_data(self, conn, data):
-        """ Insert data into the energy meter table """
-        sql = '''INSERT INTO energy_meter_data
-                 (timestamp, total_out, total_in, power_in, meter_number)
-                 VALUES (?, ?, ?, ?, ?)'''
+    def insert_energy_meter_data(self, conn, rows):
+        """ Insert rows into the energy meter table """
         try:
             cursor = conn.cursor()
-            cursor.execute(sql, data)
+            cursor.executemany(self.INSERT_ENERGY_METER_SQL, rows)
         except Error as e:
             print(e)
 
-    def dump_to_db(self, db_path: str):
-        # Connect to the SQLite database
-        conn = self.create_connection(db_path)
-        if conn is not None:
-            # Create tables
-            self.create_table(conn)
-            self.create_sum_table(conn)
-            self.create_energy_meter_table(conn)
-
-            # Existing code to handle inverter data ...
-            # Initialize variables for sums
-            power_sum = 0
-            yield_day_sum = 0
-            yield_total_sum = 0
-
-            # Get data from each inverter
-            for inverter in range(self.num_inverter):
-                # Get data
-                timestamp = datetime.now().timestamp()
-                inverter_power = self.inverter_power(inverter)
-                yield_day = self.inverter_yield_day(inverter)
-                yield_total = self.inverter_yield_total(inverter)
-                data = (timestamp, inverter, self.num_cells(inverter), inverter_power, yield_day, yield_total)
-                # Insert data
-                self.insert_inverter_data(conn, data)
-
-                # Add to sums
-                power_sum += float(inverter_power)
-                yield_day_sum += float(yield_day)
-                yield_total_sum += float(yield_total)
-
-            # Insert sum data
-            sum_data = (timestamp, power_sum, yield_day_sum, yield_total_sum)
-            self.insert_sum_data(conn, sum_data)
-
-            # Get and insert energy meter data
-            if self.tasmota_data:
-                timestamp = datetime.now().timestamp()
-                total_out = self.tasmota_data.get("", {}).get("Total_out", 0)
-                total_in = self.tasmota_data.get("", {}).get("Total_in", 0)
-                power_in = self.tasmota_data.get("", {}).get("Power_in", 0)
-                meter_number = self.tasmota_data.get("", {}).get("Meter_Number", "")
-
-                energy_meter_data = (timestamp, total_out, total_in, power_in, meter_number)
-                self.insert_energy_meter_data(conn, energy_meter_data)
-
-            # Commit the changes and close the connection
-            conn.commit()
-            conn.close()
-
-            # Log Info
-            logger.info("Data inserted into database")
-            logger.info("-- Energy meter data --")
-            logger.info(f"Timestamp: {timestamp}")
-            logger.info(f"Power in: {power_in}")
-            logger.info("-- Inverter data --")
-            logger.info(f"Power sum: {power_sum}")
-            logger.info(f"Yield day sum: {round(yield_day_sum, 2)}")
-            logger.info(f"Yield total sum: {round(yield_total_sum, 2)}")
-        else:
-            print("Error! cannot create the database connection.")
+    def flush(self):
+        """ Insert all buffered rows in one transaction """
+        if not self._pending_sum:
+            return
+        conn = self.conn
+        with conn:
+            conn.execute("BEGIN")
+            self.insert_inverter_data(conn, self._pending_inverter)
+            self.insert_sum_data(conn, self._pending_sum)
+            if self._pending_meter:
+                self.insert_energy_meter_data(conn, self._pending_meter)
+        logger.info(f"Inserted {len(self._pending_sum)} cycles into database")
+        self._pending_inverter.clear()
+        self._pending_sum.clear()
+        self._pending_meter.clear()
+
+    def dump_to_db(self):
+        # One timestamp for every row of this cycle
+        timestamp = time.time()
+
+        # Get data from each inverter
+        inverter_rows = [(timestamp, inverter, self.num_cells(inverter), self.inverter_power(inverter),
+                          self.inverter_yield_day(inverter), self.inverter_yield_total(inverter))
+                         for inverter in range(self.num_inverter)]
+
+        # Sums over all inverters
+        power_sum = sum(float(row[3]) for row in inverter_rows)
+        yield_day_sum = sum(row[4] for row in inverter_rows)
+        yield_total_sum = sum(row[5] for row in inverter_rows)
+
+        # Buffer the rows of this cycle
+        self._pending_inverter.extend(inverter_rows)
+        self._pending_sum.append((timestamp, power_sum, yield_day_sum, yield_total_sum))
+        meter = self._meter
+        if meter:
+            self._pending_meter.append((timestamp, meter["total_out"], meter["total_in"],
+                                        meter["power_in"], meter["meter_number"]))
+
+        # Commit once every FLUSH_EVERY cycles
+        if len(self._pending_sum) >= self.FLUSH_EVERY:
+            self.flush()
+
+        # Log Info
+        logger.info("Data buffered for the database")
+        logger.info("-- Energy meter data --")
+        logger.info(f"Timestamp: {timestamp}")
+        if meter:
+            logger.info(f"Power in: {meter['power_in']}")
+        logger.info("-- Inverter data --")
+        logger.info(f"Power sum: {power_sum}")
+        logger.info(f"Yield day sum: {round(yield_day_sum, 2)}")
+        logger.info(f"Yield total sum: {round(yield_total_sum, 2)}")
 
 
 # Usage
@@ -397,15 +462,17 @@ if __name__ == "__main__":
     
     # Configure logger to write to file
     logger.add(config["LOG_PATH"], rotation="1 day")
+    # Exit through atexit on SIGTERM so buffered rows get flushed
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    home = AquisitionDBStore(config["DB_PATH"], config["DTU_URL"], config["TASMOTA_URL"])
     while True:
         try:
-            week = datetime.now().isocalendar()[1]
-            home = AquisitionDBStore()
-            home.get_dtu_data(config["DTU_URL"])
-            home.get_tasmota_data(config["TASMOTA_URL"])
-            home.dump_to_db(config["DB_PATH"])
+            dtu_data, _ = home.get_data()
+            # Skip this cycle instead of storing stale inverter data
+            if dtu_data is not None:
+                home.dump_to_db()
             time.sleep(60)
         except Exception as e:
             print(e)
             logger.error(e)
-            time.sleep(60)
\ No newline at end of file
+            time.sleep(60)